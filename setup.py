@@ -32,6 +32,7 @@ setuptools.setup(
     packages=[NAME],
 
     install_requires=REQUIRED,
+    python_requires='>=3.6',
     include_package_data=True,
     license='GPLv3',
     classifiers=[
@@ -14,10 +14,11 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import logging
 import os
-import queue
 import stat
+import sys
 import threading
 
 from .__version__ import __version__
@@ -26,280 +27,311 @@ _listdir = os.listdir
 _scandir = os.scandir
 _stat = os.stat
 
+# Only Linux supports sendfile() between regular files.
+if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+    _sendfile = os.sendfile
+else:
+    _sendfile = None
+
 __all__ = ['sync']
 
 
 log = logging.getLogger(__name__)
 
 # When reading files across the network, this will be the size of each chunk.
-BUFFER_SIZE = 128 * 1024  # 128KB
+# It can be overridden for each sync using the `buffer_size` argument.
+BUFFER_SIZE = 1024 * 1024  # 1MB
+
+# When sendfile() is available, this is the most that will be requested
+# from the kernel at a time.
+SENDFILE_SIZE = 1024 * 1024 * 1024  # 1GB
 
-# The thread manager ensures that only a certain number of threads exist
+# The thread pools ensure that only a certain number of threads exist
 # at any given moment. This prevents runaway thread creation.
 count = 4
-thread_manager = threading.Semaphore(count)
-io_queue = queue.Queue(count)
 
 _isdir = stat.S_ISDIR
 _isreg = stat.S_ISREG
 _join = os.path.join
 _normpath = os.path.normpath
 _normcase = os.path.normcase
+_normcase_is_noop = _normcase('AbC') == 'AbC'
+# On Windows, DirEntry.inode() costs a stat() call and DirEntry.stat()
+# does not report devices, so inodes are not compared there.
+_compare_inodes = os.name != 'nt'
 _remove = os.remove
+# Timestamps are read by index because indexing a stat result returns
+# whole seconds, which is the precision that copy() sets them with and
+# that _compare_directory() compares them at. Other fields, such as
+# st_size, are read as attributes.
 _st_atime = stat.ST_ATIME
 _st_mode = stat.ST_MODE
 _st_mtime = stat.ST_MTIME
-_st_size = stat.ST_SIZE
-_Thread = threading.Thread
 
 
-def sync(left, right):
-    plans = plan(left, right)
-    execute(left, right, plans)
+def sync(left, right, buffer_size=None, parallel=False, hardlink=False):
+    plans = plan(left, right, parallel)
+    execute(left, right, plans, buffer_size, hardlink)
 
 
-def plan(left, right):
+def plan(left, right, parallel=False):
     left = _normcase(_normpath(left))
     right = _normcase(_normpath(right))
 
-    results = queue.Queue()
-    directories = queue.Queue()
-    directories.put('')
-    consolidated_results = queue.Queue()
-    consolidated_results.put({
+    plans = {
         'rmdir': set(),
         'rmfile': set(),
         'rmlink': set(),
         'mkdir': set(),
-        'copy': set(),
-    })
-
-    # Launch _consolidate_results in a thread.
-    args = (results, consolidated_results)
-    plan_thread = _Thread(target=_consolidate_results, args=args)
-    plan_thread.start()
-
-    # Launch _compare in a thread.
-    args = (left, right, directories, results)
-    compare_thread = _Thread(target=_compare, args=args)
-    compare_thread.start()
-
-    # Wait for all directories to be compared, then force the _compare thread
-    # to exit gracefully.
-    directories.join()
-    directories.put(None)
-    compare_thread.join()
-
-    # Wait for all results to be consolidated, then force the
-    # _consolidate_results thread to exit gracefully.
-    results.join()
-    results.put(None)
-    plan_thread.join()
-
-    # Get the final plans.
-    plans = consolidated_results.get()
-    consolidated_results.task_done()
-    consolidated_results.join()
+        'copy': {},
+    }
+
+    # Each comparison returns its plans, which are merged here,
+    # and the subdirectories it found, which are then compared in turn.
+    if not parallel:
+        # Threads only help when listing directories blocks for a long time,
+        # as on network shares. Otherwise, compare the directories in order.
+        directories = ['']
+        while directories:
+            args = (left, right, directories.pop())
+            result, found = _compare_directory(*args)
+            for k, v in result.items():
+                plans[k].update(v)
+            directories.extend(found)
+
+        return plans
+
+    # Compare the directories in a thread pool.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=count) as pool:
+        args = (left, right, '')
+        pending = {pool.submit(_compare_directory, *args)}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for future in done:
+                result, directories = future.result()
+                for k, v in result.items():
+                    plans[k].update(v)
+                for directory in directories:
+                    args = (left, right, directory)
+                    pending.add(pool.submit(_compare_directory, *args))
 
     return plans
 
 
-def execute(left, right, plans):
+def execute(left, right, plans, buffer_size=None, hardlink=False):
+    if buffer_size is None:
+        buffer_size = BUFFER_SIZE
+
     log.debug('Executing from "{}" to "{}"'.format(left, right))
-    log.debug('Using buffer size: {}'.format(BUFFER_SIZE))
+    log.debug('Using buffer size: {}'.format(buffer_size))
 
     # Ensure the right side exists.
     if not os.path.exists(right):
         os.makedirs(right)
 
-    # Remove files on the right side.
-    for filename in plans['rmfile']:
-        thread_manager.acquire()
-        io_queue.put(None)
-        thread = _Thread(target=unlink, args=(_join(right, filename),))
-        thread.start()
-
-    io_queue.join()
-
-    # Remove directories on the right side.
-    for directory in sorted(plans['rmdir'], reverse=True):
-        os.rmdir(_join(right, directory))
-
-    # Make new directories on the right side.
-    for directory in sorted(plans['mkdir']):
-        os.makedirs(_join(right, directory))
-
-    # Copy files from the left side to the right side.
-    for path, stats in sorted(plans['copy'], key=lambda x: x[1][_st_size], reverse=True):
-        thread_manager.acquire()
-        io_queue.put(None)
-        thread = _Thread(target=copy, args=(left, right, path, stats))
-        thread.start()
-
-    io_queue.join()
-
+    # Hard links can only be created on the same device.
+    if hardlink:
+        hardlink = _stat(left).st_dev == _stat(right).st_dev
+        log.debug('Using hard links: {}'.format(hardlink))
+
+    # The same threads are used to remove files and to copy files.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=count) as pool:
+        # Remove files on the right side.
+        futures = [
+            pool.submit(unlink, _join(right, filename))
+            for filename in plans['rmfile']
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+        # Remove directories on the right side.
+        for directory in sorted(plans['rmdir'], reverse=True):
+            os.rmdir(_join(right, directory))
+
+        # Make new directories on the right side.
+        for directory in sorted(plans['mkdir']):
+            os.makedirs(_join(right, directory))
+
+        # Copy files from the left side to the right side, largest first.
+        copies = plans['copy'].items()
+        copies = sorted(copies, key=lambda item: item[1].st_size, reverse=True)
+        futures = [
+            pool.submit(copy, left, right, path, stats, buffer_size, hardlink)
+            for path, stats in copies
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+
+def listdir(path):
+    """List a directory's entries, keyed by their normalized names.
+
+    Each value is a tuple of the entry and whether it is a directory
+    and a file, so that each entry's type is only looked up once.
+    If an entry's type cannot be looked up, it is neither.
+    If the directory cannot be read, an empty dictionary is returned.
+
+    :param str path: The directory to list.
+    :rtype: dict
+    """
 
-def listdir(results, path):
+    # scandir.DirEntry supports hashing but not equality comparisons
+    # so we must use the .name attribute for equality comparisons.
+    # Skip normalizing the names on platforms where it does nothing.
+    listing = {}
     try:
-        results.put(list(_scandir(path)))
+        with _scandir(path) as entries:
+            for entry in entries:
+                if _normcase_is_noop:
+                    name = entry.name
+                else:
+                    name = _normcase(entry.name)
+
+                # Looking up the type of a symlink can fail, for example
+                # because of a symlink loop. That must not affect the
+                # rest of the listing.
+                try:
+                    listing[name] = (entry, entry.is_dir(), entry.is_file())
+                except OSError as error:
+                    log.debug('{}: {}'.format(error.__class__.__name__, error))
+                    listing[name] = (entry, False, False)
     except OSError:
-        results.put([])
-
-
-def _consolidate_results(results, consolidated_results):
-    """
-    :type results: queue.Queue
-    :type consolidated_results: queue.Queue
-    """
-
-    plans = consolidated_results.get()
-
-    while 1:
-        result = results.get()
-        if result is None:
-            break
-
-        for k, v in result.items():
-            plans[k].update(v)
-        results.task_done()
-
-    consolidated_results.put(plans)
-    consolidated_results.task_done()
-
-
-def _compare(left, right, directories, results):
-    """
-    :type left: str
-    :type right: str
-    :type directories: queue.Queue
-    :type results: queue.Queue
-    :return:
-    """
-
-    while 1:
-        relative_directory = directories.get()
-        if relative_directory is None:
-            break
+        return {}
 
-        args = (left, right, relative_directory, directories, results)
-        thread_manager.acquire()
-        thread = _Thread(target=_compare_directory, args=args)
-        thread.start()
+    return listing
 
 
-def _compare_directory(left, right, relative_path, directories, results):
+def _compare_directory(left, right, relative_path):
     """
     :type left: str
     :type right: str
     :type relative_path: str
-    :type directories: queue.Queue
-    :type results: queue.Queue
+    :return: The plans for the directory, and the subdirectories
+        that must be compared next.
+    :rtype: tuple
     """
 
+    directories = []
+
     plans = {
         'rmdir': set(),
         'rmfile': set(),
         'rmlink': set(),
         'mkdir': set(),
-        'copy': set(),
+        'copy': {},
     }
 
-    left_path = _join(left, relative_path)
-    left_result = queue.Queue(maxsize=1)
-    left_thread = _Thread(target=listdir, args=(left_result, left_path))
-    left_thread.start()
-
-    right_path = _join(right, relative_path)
-    right_result = queue.Queue(maxsize=1)
-    right_thread = _Thread(target=listdir, args=(right_result, right_path))
-    right_thread.start()
-
-    left_thread.join()
-    right_thread.join()
-
-    # scandir.DirEntry supports hashing but not equality comparisons
-    # so we must use the .name attribute for equality comparisons.
-    left_listing = {_normcase(i.name): i for i in left_result.get()}
-    left_result.task_done()
-    left_result.join()
-    right_listing = {_normcase(i.name): i for i in right_result.get()}
-    right_result.task_done()
-    right_result.join()
-
-    # Case 1: The file/directory only exists on the left.
-    for name in left_listing.keys() - right_listing.keys():
-        left_path = _join(relative_path, left_listing[name].name)
-        if left_listing[name].is_dir():
-            directories.put(left_path)
-            plans['mkdir'].add(left_path)
+    left_listing = listdir(_join(left, relative_path))
+    right_listing = listdir(_join(right, relative_path))
+
+    # Concatenating strings is much cheaper than calling os.path.join().
+    prefix = relative_path + os.sep if relative_path else ''
+
+    # Bind the names used for every entry to locals, which are faster
+    # to look up than globals and attributes.
+    add_directory = directories.append
+    add_mkdir = plans['mkdir'].add
+    add_rmdir = plans['rmdir'].add
+    add_rmfile = plans['rmfile'].add
+    copies = plans['copy']
+    st_mtime = _st_mtime
+
+    # Sort the names into the cases below with one lookup per name,
+    # rather than building three intermediate sets.
+    left_only = []
+    right_only = []
+    common = []
+    add_left_only = left_only.append
+    add_right_only = right_only.append
+    add_common = common.append
+    for name in left_listing:
+        if name in right_listing:
+            add_common(name)
         else:
-            # stat() the file in a separate thread.
-            thread = _Thread(target=left_listing[name].stat)
-            thread.start()
-            thread.join()
+            add_left_only(name)
+    for name in right_listing:
+        if name not in left_listing:
+            add_right_only(name)
 
-            # The stat() call below was cached above by scandir.DirEntry.
-            left_stat = left_listing[name].stat()
-            plans['copy'].add((left_path, left_stat))
+    # Case 1: The file/directory only exists on the left.
+    for name in left_only:
+        left_entry, left_is_dir, left_is_file = left_listing[name]
+        left_path = prefix + left_entry.name
+        if left_is_dir:
+            add_directory(left_path)
+            add_mkdir(left_path)
+        elif left_is_file:
+            left_stat = left_entry.stat()
+            copies[left_path] = left_stat
 
     # Case 2: The file/directory only exists on the right.
-    for name in right_listing.keys() - left_listing.keys():
-        right_path = _join(relative_path, right_listing[name].name)
-        if right_listing[name].is_dir():
-            directories.put(right_path)
-            plans['rmdir'].add(right_path)
+    for name in right_only:
+        right_entry, right_is_dir, _ = right_listing[name]
+        right_path = prefix + right_entry.name
+        if right_is_dir:
+            add_directory(right_path)
+            add_rmdir(right_path)
         else:
-            plans['rmfile'].add(right_path)
+            add_rmfile(right_path)
 
     # Case 3: The path exists on both the left and right sides.
-    for name in left_listing.keys() & right_listing.keys():
-        left_path = _join(relative_path, left_listing[name].name)
-        right_path = _join(relative_path, right_listing[name].name)
+    for name in common:
+        left_entry, left_is_dir, left_is_file = left_listing[name]
+        right_entry, right_is_dir, right_is_file = right_listing[name]
+        left_path = prefix + left_entry.name
+        right_path = prefix + right_entry.name
+
+        # If both sides have the same device and inode, they are the same
+        # file or directory (for example, hard links to one file, or the
+        # same tree on both sides) and there is nothing to compare or copy.
+        # DirEntry.inode() is free on POSIX, so it is used as a first filter
+        # and only entries whose inodes match are lstat()ed. The decision
+        # uses the device and inode from lstat() alone, because for a mount
+        # point DirEntry.inode() is the inode of the directory underneath.
+        if _compare_inodes and left_entry.inode() == right_entry.inode():
+            left_lstat = left_entry.stat(follow_symlinks=False)
+            right_lstat = right_entry.stat(follow_symlinks=False)
+            if (
+                left_lstat.st_dev == right_lstat.st_dev
+                and left_lstat.st_ino == right_lstat.st_ino
+            ):
+                continue
 
         # Case 3.1: The left side is a directory.
-        if left_listing[name].is_dir():
-            directories.put(left_path)
+        if left_is_dir:
+            add_directory(left_path)
             # If the right side is a file it must be removed.
-            if right_listing[name].is_file():
-                plans['rmfile'].add(right_path)
+            if right_is_file:
+                add_rmfile(right_path)
 
         # Case 3.2: The left side is a file.
-        elif left_listing[name].is_file():
-            # stat() the file in a separate thread.
-            thread = _Thread(target=left_listing[name].stat)
-            thread.start()
-            thread.join()
-
-            # The stat() call below was cached above by scandir.DirEntry.
-            left_stat = left_listing[name].stat()
+        elif left_is_file:
+            left_stat = left_entry.stat()
 
             # If the right side is a directory, it must be recursively removed
             # and the file on the left side must be copied to the right side.
-            if right_listing[name].is_dir():
-                directories.put(right_path)
-                plans['rmdir'].add(right_path)
-                plans['copy'].add((left_path, left_stat))
+            if right_is_dir:
+                add_directory(right_path)
+                add_rmdir(right_path)
+                copies[left_path] = left_stat
 
             # If the right side is a file, its size and attributes must match
             # the size and attributes of the file on the left side.
-            elif right_listing[name].is_file():
-                thread = _Thread(target=right_listing[name].stat)
-                thread.start()
-                thread.join()
+            elif right_is_file:
+                right_stat = right_entry.stat()
 
-                # The stat() call below was cached above by scandir.DirEntry.
-                right_stat = right_listing[name].stat()
+                # If the file sizes or modification times differ, copy the
+                # file. Modification times are compared in whole seconds,
+                # which is the precision that copy() sets them with.
+                if (
+                    left_stat.st_size != right_stat.st_size
+                    or left_stat[st_mtime] != right_stat[st_mtime]
+                ):
+                    copies[left_path] = left_stat
 
-                # If the file sizes differ, copy the file.
-                if left_stat[_st_size] != right_stat[_st_size]:
-                    plans['copy'].add((left_path, left_stat))
-                # If the file modification times differ, copy the file.
-                if left_stat[_st_mtime] != right_stat[_st_mtime]:
-                    plans['copy'].add((left_path, left_stat))
-
-    results.put(plans)
-    directories.task_done()
-    thread_manager.release()
+    return plans, directories
 
 
 def unlink(path):
@@ -308,113 +340,102 @@ def unlink(path):
     """
 
     os.unlink(path)
-    thread_manager.release()
-    io_queue.get()
-    io_queue.task_done()
 
 
-def copy(left, right, path, stats):
+def copy(left, right, path, stats, buffer_size=BUFFER_SIZE, hardlink=False):
     """
     :type left: str
     :type right: str
     :type path: str
     :type stats: list
+    :type buffer_size: int
+    :type hardlink: bool
     """
 
-    blobs = queue.Queue(8)
-
-    # Open the left and right files.
-    reader_queue = queue.Queue(maxsize=1)
-    get_reader_thread = _Thread(target=open_file, args=[_join(left, path), 'rb', reader_queue])
-    get_reader_thread.start()
-    writer_queue = queue.Queue(maxsize=1)
-    get_writer_thread = _Thread(target=open_file, args=[_join(right, path), 'wb', writer_queue])
-    get_writer_thread.start()
-    src = reader_queue.get()
-    dst = writer_queue.get()
-
-    # If both files were opened successfully, copy the contents.
-    if src and dst:
-        # Launch a thread for reading.
-        read_thread = _Thread(target=read, args=(src, blobs))
-        read_thread.start()
-
-        # Launch a thread for writing.
-        write_thread = _Thread(target=write, args=(dst, blobs))
-        write_thread.start()
+    # Try to hard link the file into place before copying its contents.
+    if hardlink:
+        try:
+            link(_join(left, path), _join(right, path))
+            return
+        except OSError as error:
+            log.debug('{}: {}'.format(error.__class__.__name__, error))
 
-        read_thread.join()
-        write_thread.join()
-
-        src.close()
-        dst.close()
+    try:
+        with open(_join(left, path), 'rb') as src:
+            # Read at least several filesystem blocks at a time.
+            blksize = getattr(os.fstat(src.fileno()), 'st_blksize', 0)
+            size = max(buffer_size, blksize * 8)
+            with open(_join(right, path), 'wb') as dst:
+                copy_contents(src, dst, size)
 
         # Update the access and modification times.
         os.utime(_join(right, path), (stats[_st_atime], stats[_st_mtime]))
-
-    # If only one file was successfully opened, be sure to close it.
-    if src:
-        src.close()
-    if dst:
-        dst.close()
-
-    thread_manager.release()
-    io_queue.get()
-    io_queue.task_done()
-
-
-def read(src, blobs, size=BUFFER_SIZE):
-    try:
-        while 1:
-            blob = src.read(size)
-            if not blob:
-                break
-            blobs.put(blob)
-    except IOError as error:
+    except OSError as error:
         log.debug('{}: {}'.format(error.__class__.__name__, error))
-    finally:
-        src.close()
 
-    blobs.put(None)
 
+def link(src, dst):
+    """Replace a file with a hard link to another file.
 
-def write(dst, blobs):
-    try:
-        while 1:
-            blob = blobs.get()
-            if blob is None:
-                break
-            dst.write(blob)
-            blobs.task_done()
-    except IOError as error:
-        log.debug('{}: {}'.format(error.__class__.__name__, error))
+    The link is created next to the destination and then renamed over it,
+    so the destination is never partially written.
 
-        # If there's an error, the queue still needs to get cleared.
-        # Eventually it will be important to kill the reader thread
-        # instead of letting it just keep reading.
-        while 1:
-            blob = blobs.get()
-            if blob is None:
-                break
-    finally:
-        dst.close()
+    :param str src: The file to link to.
+    :param str dst: The file to replace.
+    """
 
+    # The temporary name is hidden and unique to this process and thread,
+    # so links made in parallel cannot collide with each other or with
+    # files on the left side. A stale link left by an interrupted run
+    # with the same name is removed.
+    directory, name = os.path.split(dst)
+    temporary = _join(directory, '.{}.{}-{}.syncopath'.format(
+        name, os.getpid(), threading.get_ident(),
+    ))
+    try:
+        os.link(src, temporary)
+    except FileExistsError:
+        os.unlink(temporary)
+        os.link(src, temporary)
+    try:
+        os.replace(temporary, dst)
+    except OSError:
+        os.unlink(temporary)
+        raise
 
-def open_file(path, mode, pipe):
-    """Open a path for reading or writing.
 
-    The file object will be put into the queue if the file is successfully
-    opened. If there is an exception it will be put into the pipe instead.
+def copy_contents(src, dst, size=BUFFER_SIZE):
+    """Copy the contents of one open file to another.
 
-    The file will need to be closed later.
+    On Linux, the copy is performed in the kernel using ``os.sendfile()``.
+    Otherwise, the contents are copied in chunks.
 
-    :param str path: The path to the file.
-    :param str mode: The mode to open the file with.
-    :param queue.Queue pipe: The open file or an error will be put in the pipe.
+    :param src: The file to read from.
+    :param dst: The file to write to.
+    :param int size: The size of each chunk when falling back to reads/writes.
     """
 
-    try:
-        pipe.put(open(path, mode))
-    except IOError as error:
-        log.debug('{}: {}'.format(error.__class__.__name__, str(error)))
-        pipe.put(None)
+    if _sendfile is not None:
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+        copied = 0
+        try:
+            while 1:
+                sent = _sendfile(dst_fd, src_fd, None, SENDFILE_SIZE)
+                if not sent:
+                    return
+                copied += sent
+        except OSError:
+            # Some filesystems do not support sendfile().
+            # Fall back to reads/writes if nothing was copied yet.
+            if copied:
+                raise
+
+    # Reuse a single buffer for every chunk.
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    while 1:
+        length = src.readinto(buffer)
+        if not length:
+            break
+        dst.write(view[:length])